@@ -1,12 +1,12 @@
 import torch
 import torchaudio
-import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from tqdm import tqdm
 
 def get_duration(path):
-    audio, sr = torchaudio.load(path)
-    return path, len(audio[0]) / sr
+    info = torchaudio.info(path) # Reads only the header
+    return path, info.num_frames / info.sample_rate
 
 def main():
 
@@ -23,19 +23,17 @@ def main():
     for op in ops:
         print("Calculating durations...")
         durations = []
-        with multiprocessing.Manager() as manager:
-            files = manager.list(op[1])
-            with multiprocessing.Pool(processes=8) as pool:
-                for result in tqdm(pool.imap_unordered(get_duration, files, chunksize=32), total=len(files)):
-                    path, duration = result
-                    durations.append((path, duration))
+        files = op[1]
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            for result in tqdm(executor.map(get_duration, files), total=len(files)):
+                path, duration = result
+                durations.append((path, duration))
 
         # Writing file list
         print("Writing file list...")
         sorted_files = sorted(durations, key=lambda x: (-x[1], x[0]))
         with open("./datasets/" + op[0] + ".csv", "w") as filelist:
-            for file in sorted_files:
-                filelist.write(file[0] + "," + str(file[1]) + "\n")
+            filelist.writelines(file[0] + "," + str(file[1]) + "\n" for file in sorted_files)
 
     # Calculate mixture
                 
@@ -0,0 +1,87 @@
+import os
+import sys
+import torch
+import numpy as np
+from glob import glob
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from supervoice.config import config
+from supervoice.tokenizer import Tokenizer
+from supervoice.alignment import parse_textgrid_alignments, continious_phonemes_to_discreete
+
+#
+# Packs all spectograms of a prepared dataset into a single flat archive:
+#   audio.bin - float32 frames of shape (T_total, C)
+#   index.npy - int64 array of [offset, frames] for each file
+#   files.txt - file names (relative to the dataset directory, without extension)
+#
+# And all alignments of an aligned dataset into:
+#   tokens.npy - int32 token ids of discreete intervals
+#   durations.npy - int32 durations of discreete intervals
+#   index.npy - int64 array of [offset, intervals] for each file
+#   files.txt - file names (relative to the dataset directory, without extension)
+#
+
+def pack_audio(dataset_dir):
+
+    # Spectograms prepared before the (T, C) layout have to be converted first
+    if not os.path.exists(dataset_dir + "/layout.txt"):
+        raise Exception("Spectograms in " + dataset_dir + " are not marked as (T, C), run datasets_transpose.py first")
+
+    # Enumerate spectograms
+    files = glob(dataset_dir + "/*/*.pt")
+    files = sorted([f for f in files if not f.endswith(".style.pt")])
+
+    # Write audio
+    index = []
+    offset = 0
+    with open(dataset_dir + "/audio.bin", "wb") as archive:
+        for file in tqdm(files):
+            spec = torch.load(file, map_location="cpu", mmap=True, weights_only=True).float() # Already (T, C)
+            assert spec.shape[1] == config.audio.n_mels
+            archive.write(spec.numpy().tobytes())
+            index.append((offset, spec.shape[0]))
+            offset += spec.shape[0]
+
+    # Write index
+    np.save(dataset_dir + "/index.npy", np.array(index, dtype=np.int64).reshape(-1, 2))
+    with open(dataset_dir + "/files.txt", "w") as filelist:
+        filelist.writelines(f[len(dataset_dir + "/"):-len(".pt")] + "\n" for f in files)
+
+def pack_alignments(dataset_dir, tokenizer):
+    phoneme_duration = config.audio.hop_size / config.audio.sample_rate
+
+    # Enumerate textgrids
+    files = sorted(glob(dataset_dir + "/*/*.TextGrid"))
+
+    # Convert to discreete intervals
+    def parse(file):
+        return continious_phonemes_to_discreete(parse_textgrid_alignments(file), phoneme_duration)
+    tokens = []
+    durations = []
+    index = []
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        parsed = list(tqdm(executor.map(parse, files), total=len(files)))
+    for phonemes, d in parsed:
+        index.append((len(tokens), len(phonemes)))
+        tokens += tokenizer(phonemes.tolist()).tolist()
+        durations += d.tolist()
+
+    # Write
+    np.save(dataset_dir + "/tokens.npy", np.array(tokens, dtype=np.int32))
+    np.save(dataset_dir + "/durations.npy", np.array(durations, dtype=np.int32))
+    np.save(dataset_dir + "/index.npy", np.array(index, dtype=np.int64).reshape(-1, 2))
+    with open(dataset_dir + "/files.txt", "w") as filelist:
+        filelist.writelines(f[len(dataset_dir + "/"):-len(".TextGrid")] + "\n" for f in files)
+
+def main():
+    tokenizer = Tokenizer(config)
+    names = sys.argv[1:] if len(sys.argv) > 1 else ["libritts", "vctk", "eval"]
+    for name in names:
+        print(f"Packing {name}...")
+        pack_audio("datasets/" + name + "-prepared")
+        if os.path.isdir("datasets/" + name + "-aligned"): # Pretraining datasets are not aligned
+            pack_alignments("datasets/" + name + "-aligned", tokenizer)
+
+if __name__ == "__main__":
+    main()
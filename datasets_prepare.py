@@ -72,7 +72,7 @@ def execute_parallel(args):
     # Save
     target_dir = os.path.join(collection_dir, speaker_directory(speaker))
     torchaudio.save(os.path.join(target_dir, target_name + ".wav"), waveform.unsqueeze(0).cpu(), config.audio.sample_rate)
-    torch.save(spec.cpu(), os.path.join(target_dir, target_name + ".pt"))
+    torch.save(spec.transpose(0, 1).contiguous().cpu(), os.path.join(target_dir, target_name + ".pt")) # Saved as (T, C)
     torch.save(style.cpu(), os.path.join(target_dir, target_name + ".style.pt"))
     with open(os.path.join(target_dir, target_name + ".txt"), "w", encoding="utf-8") as f:
         f.write(text)
@@ -239,6 +239,10 @@ def execute_run():
                 for result in tqdm(pool.imap_unordered(execute_parallel, args_list, chunksize=32), total=len(files)):
                     pass
 
+        # Mark spectogram layout, checked by datasets_pack.py
+        with open(prepared_dir + "layout.txt", "w") as f:
+            f.write("T, C\n")
+
     # End
     print("Done")
 
@@ -7,7 +7,7 @@ from supervoice.model_style import _convert_to_continuous_f0
 
 def get_stats(path):
     base_path = path[:-4]
-    style = torch.load(base_path + ".style.pt")
+    style = torch.load(base_path + ".style.pt", map_location="cpu", mmap=True, weights_only=True)
     style = _convert_to_continuous_f0(style)
     style = (style - style.mean()) / style.std()
     return (style.mean().item(), style.std().item(), style.max().item(), style.min().item())
@@ -0,0 +1,35 @@
+import os
+import torch
+from glob import glob
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from supervoice.config import config
+
+#
+# One-off conversion of spectograms prepared before they were saved as (T, C).
+# Converted datasets (and ones prepared after the change) are marked with a layout.txt file and skipped,
+# shapes alone can't tell the layouts apart (T == C). Run it before datasets_pack.py.
+#
+
+def transpose(path):
+    spec = torch.load(path, map_location="cpu")
+    assert spec.shape[0] == config.audio.n_mels, "Unexpected spectogram shape in " + path
+    torch.save(spec.transpose(0, 1).contiguous(), path) # (C, T) -> (T, C)
+
+def main():
+    for name in ["libritts", "vctk", "eval"]:
+        dataset_dir = "datasets/" + name + "-prepared"
+        if os.path.exists(dataset_dir + "/layout.txt"):
+            print(f"Dataset {name} is already (T, C)")
+            continue
+        print(f"Transposing {name}...")
+        files = glob(dataset_dir + "/*/*.pt")
+        files = [f for f in files if not f.endswith(".style.pt")]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for _ in tqdm(executor.map(transpose, files), total=len(files)):
+                pass
+        with open(dataset_dir + "/layout.txt", "w") as f:
+            f.write("T, C\n")
+
+if __name__ == "__main__":
+    main()
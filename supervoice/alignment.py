@@ -1,68 +1,60 @@
+import re
+import numpy as np
 from .model_style import resolve_style
 
-def normalize_continious_phonemes(src):
-    """
-    Normalizing and fixing holes in phonemes
-    """
-    res = []
-    time = 0
-    for t in src:
-        tok = t[0]
-        start = t[1]
-        end = t[2]
-        if start != time:
-            res.append(('<SIL>', time, start))
-        res.append(t)
-        time = end
-    return res
-
+textgrid_tier = re.compile(r'item \[\d+\]:')
+textgrid_interval = re.compile(r'xmin = (\S+)\s+xmax = (\S+)\s+text = "((?:[^"]|"")*)"')
 
 def extract_textgrid_alignments(tg):
     """
-    Converts a TextGrid object to a list of tuples (phoneme, start, end)
+    Converts a TextGrid object to parallel arrays of phonemes, starts and ends
     """
-    output = []
-    for t in tg[1]:
-        ends = t.maxTime
-        tok = t.mark
-        if tok == '': # Ignore spaces
-            continue
-        if tok == 'spn':
-            tok = '<UNK>'
-        output.append((tok, t.minTime, t.maxTime))
-    return output
-
-def quantisize_phoneme_positions(src, phoneme_duration):
+    tier = [t for t in tg[1] if t.mark != ''] # Ignore spaces
+    phonemes = np.array([('<UNK>' if t.mark == 'spn' else t.mark) for t in tier], dtype=object)
+    starts = np.array([t.minTime for t in tier], dtype=np.float64)
+    ends = np.array([t.maxTime for t in tier], dtype=np.float64)
+    return phonemes, starts, ends
+
+
+def parse_textgrid_alignments(path):
     """
-    Quantisize phoneme positions, according to the single token duration
+    Parses a long format TextGrid file directly into parallel arrays of phonemes, starts and ends, same as extract_textgrid_alignments
     """
-    res = []
-    for t in src:
-        tok = t[0]
-        # NOTE: We are expecting src to be normalized and start and end to match in adjacent tokens
-        start = int(t[1] // phoneme_duration)
-        end = int(t[2] // phoneme_duration)
-        res.append((tok, start, end))
-    return res
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Phonemes tier (second one)
+    tier = textgrid_tier.split(content)[2]
+    intervals = [i for i in textgrid_interval.findall(tier) if i[2] != ''] # Ignore spaces
+
+    phonemes = np.array([('<UNK>' if i[2] == 'spn' else i[2].replace('""', '"')) for i in intervals], dtype=object)
+    starts = np.array([float(i[0]) for i in intervals], dtype=np.float64)
+    ends = np.array([float(i[1]) for i in intervals], dtype=np.float64)
+    return phonemes, starts, ends
 
 
 def continious_phonemes_to_discreete(raw_phonemes, phoneme_duration):
     """
-    Convert continious phonemes to a list of integer intervals
+    Convert continious phonemes (phonemes, starts, ends) to arrays of phonemes and integer durations
     """
+    phonemes, starts, ends = raw_phonemes
 
     # Normalize: add silence between intervals,
     #            ensure that start of any token is equal to end of a previous,
     #            ensure that first token is zero
-    raw_phonemes = normalize_continious_phonemes(raw_phonemes)
+    previous_ends = np.concatenate([[0.], ends[:-1]])
+    holes = np.flatnonzero(starts != previous_ends)
+    phonemes = np.insert(phonemes, holes, '<SIL>')
+    ends = np.insert(ends, holes, starts[holes])
 
     # Quantisize offsets: convert from real one to a discreete one
-    quantisized = quantisize_phoneme_positions(raw_phonemes, phoneme_duration)
+    # NOTE: After normalization start of each token is the end of a previous one
+    boundaries = np.floor_divide(np.concatenate([[0.], ends]), phoneme_duration).astype(np.int64)
 
     # Convert to intervals
-    intervals = [(i[0], i[2] - i[1]) for i in quantisized]
+    durations = np.diff(boundaries)
 
-    return intervals
+    return phonemes, durations
 
 
 def compute_alignments(config, tg, style, total_duration, adjust_style=True):
@@ -76,19 +68,45 @@ def compute_alignments(config, tg, style, total_duration, adjust_style=True):
     x = extract_textgrid_alignments(tg)
 
     # Convert to discreete
-    x = continious_phonemes_to_discreete(x, phoneme_duration)
+    phonemes, durations = continious_phonemes_to_discreete(x, phoneme_duration)
+
+    return compute_discreete_alignments(config, phonemes, durations, style, total_duration, adjust_style=adjust_style)
+
+
+def pad_discreete_alignments(phonemes, durations, total_duration, silence_token):
+    """
+    Trim empty intervals and pad discreete phonemes with silence up to the total duration
+    """
 
     # Trim empty
-    x = [i for i in x if i[1] > 0]
+    keep = durations > 0
+    phonemes = phonemes[keep]
+    durations = durations[keep]
 
     # Pad with silence
-    total_length = sum([i[1] for i in x])
+    total_length = durations.sum()
     assert total_length <= total_duration # We don't have reversed case in our datasets
     if total_length < total_duration: # Pad with silence because textgrid is usually shorter
-        x += [(config.tokenizer.silence_token, total_duration - total_length)]
+        phonemes = np.append(phonemes, silence_token)
+        durations = np.append(durations, total_duration - total_length)
+
+    return phonemes, durations
+
+
+def compute_discreete_alignments(config, phonemes, durations, style, total_duration, silence_token=None, adjust_style=True):
+    """
+    Compute alignments from arrays of discreete phonemes and durations and style tensor
+    """
+
+    if silence_token is None:
+        silence_token = config.tokenizer.silence_token
+
+    # Trim and pad
+    phonemes, durations = pad_discreete_alignments(phonemes, durations, total_duration, silence_token)
+    x = list(zip(phonemes.tolist(), durations.tolist()))
 
     # Style tokens
     y = resolve_style(config, style, [i[1] for i in x])
     x = [(xi[0], xi[1], yi + 1 if adjust_style else yi) for xi, yi in zip(x, y)]
 
-    return x
\ No newline at end of file
+    return x
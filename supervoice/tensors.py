@@ -1,6 +1,5 @@
 import torch
 import torch.nn.functional as F
-import random
 
 class RMSNorm(torch.nn.Module):
     def __init__(self, dim):
@@ -34,12 +33,8 @@ def merge_mask(source, replacement, mask):
     return torch.where(mask, replacement, source)
 
 def interval_mask(batch_size, length, min_interval, max_interval, probability_all, device):
-    tensor = torch.full((batch_size, length), False, device = device, dtype = torch.bool)
-    for i in range(batch_size):
-        interval_length = random.randint(min_interval, max_interval)
-        if random.random() < probability_all or interval_length == length:
-            tensor[i] = True
-            continue
-        start_point = random.randint(0, length - interval_length - 1)
-        tensor[i, start_point:start_point + interval_length] = True 
-    return tensor
\ No newline at end of file
+    interval_length = torch.randint(min_interval, max_interval + 1, (batch_size, 1), device = device)
+    start_point = (torch.rand((batch_size, 1), device = device) * (length - interval_length)).long() # Uniform in [0, length - interval_length - 1]
+    everything = (torch.rand((batch_size, 1), device = device) < probability_all) | (interval_length == length)
+    positions = torch.arange(length, device = device)
+    return ((positions >= start_point) & (positions < start_point + interval_length)) | everything
@@ -20,7 +20,7 @@ import torch
 import torch.nn.functional as F
 from einops import rearrange, reduce, repeat
 from accelerate import Accelerator, DistributedDataParallelKwargs
-from accelerate.utils import set_seed
+from accelerate.utils import set_seed, DataLoaderConfiguration
 import wandb
 
 # Local
@@ -60,20 +60,21 @@ train_max_segment_size = 500
 train_lr_start = 1e-10
 train_lr_max = 1e-4
 train_warmup_steps = 5000
-train_mixed_precision = "fp16" # "bf16" or "fp16" or None
+train_mixed_precision = "bf16" # "bf16" or "fp16" or None
 train_clip_grad_norm = 0.2
 train_sigma = 1e-5
+train_compile = False
 
 # Train
 def main():
 
     # Prepare accelerator
     ddp_kwargs = DistributedDataParallelKwargs(find_unused_parameters=True)
-    accelerator = Accelerator(log_with="wandb", kwargs_handlers=[ddp_kwargs], gradient_accumulation_steps = train_grad_accum_every, mixed_precision=train_mixed_precision)
+    dataloader_config = DataLoaderConfiguration(non_blocking=True) # Batches are pinned by the loaders, copy them asynchronously
+    accelerator = Accelerator(log_with="wandb", kwargs_handlers=[ddp_kwargs], dataloader_config=dataloader_config, gradient_accumulation_steps = train_grad_accum_every, mixed_precision=train_mixed_precision)
     device = accelerator.device
     output_dir = Path("./output")
     output_dir.mkdir(parents=True, exist_ok=True)
-    dtype = torch.float16 if train_mixed_precision == "fp16" else (torch.bfloat16 if train_mixed_precision == "bf16" else torch.float32)
     torch.backends.cuda.matmul.allow_tf32 = True
     torch.backends.cudnn.allow_tf32 = True 
     set_seed(42)
@@ -85,21 +86,24 @@ def main():
     tokenizer = Tokenizer(config)
     phoneme_duration = config.audio.hop_size / config.audio.sample_rate
     if train_pretraining:
-        train_loader = get_aligned_dataset_dumb_loader(path = train_pretraining_filelist, max_length = train_max_segment_size, workers = train_loader_workers, batch_size = train_batch_size, tokenizer = tokenizer, phoneme_duration = phoneme_duration, dtype = dtype)
+        train_loader = get_aligned_dataset_dumb_loader(path = train_pretraining_filelist, max_length = train_max_segment_size, workers = train_loader_workers, batch_size = train_batch_size, tokenizer = tokenizer, phoneme_duration = phoneme_duration)
     else:
-        train_loader = get_aligned_dataset_loader(names = train_datasets, voices = train_voices, max_length = train_max_segment_size, workers = train_loader_workers, batch_size = train_batch_size, tokenizer = tokenizer, phoneme_duration = phoneme_duration, dtype = dtype)
-    test_loader = get_aligned_dataset_loader(names = ["eval"], voices = None, max_length = train_max_segment_size, workers = train_loader_workers, batch_size = train_evaluate_batch_size, tokenizer = tokenizer, phoneme_duration = phoneme_duration, dtype = dtype)
+        train_loader = get_aligned_dataset_loader(names = train_datasets, voices = train_voices, max_length = train_max_segment_size, workers = train_loader_workers, batch_size = train_batch_size, tokenizer = tokenizer, phoneme_duration = phoneme_duration, compiled = train_compile)
+    test_loader = get_aligned_dataset_loader(names = ["eval"], voices = None, max_length = train_max_segment_size, workers = train_loader_workers, batch_size = train_evaluate_batch_size, tokenizer = tokenizer, phoneme_duration = phoneme_duration, compiled = train_compile)
 
     # Prepare model
     accelerator.print("Loading model...")
     step = 0
-    raw_model = AudioPredictor(config)
+    raw_model = AudioPredictor(config).to(device) # Fused optimizer expects parameters to be on the device already
     model = raw_model
+    if train_compile:
+        torch._dynamo.config.cache_size_limit = 64 # One graph for each bucketed sequence length
+        model = torch.compile(raw_model, mode="reduce-overhead", fullgraph=True, dynamic=False)
     wd_params, no_wd_params = [], []
     for param in model.parameters():
         param_list = no_wd_params if param.ndim < 2 else wd_params
         param_list.append(param)
-    optim = torch.optim.AdamW([{'params': wd_params}, {'params': no_wd_params, 'weight_decay': 0}], lr_max, betas=[0.9, 0.99], weight_decay=0.01)
+    optim = torch.optim.AdamW([{'params': wd_params}, {'params': no_wd_params, 'weight_decay': 0}], lr_max, betas=(0.9, 0.99), weight_decay=0.01, fused=True)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optim, T_max = train_steps)
 
     # Accelerate
@@ -117,6 +121,7 @@ def main():
         "warmup_steps": train_warmup_steps,
         "mixed_precision": train_mixed_precision,
         "clip_grad_norm": train_clip_grad_norm,
+        "compile": train_compile,
     }
     accelerator.init_trackers(train_project, config=hps)
     if accelerator.is_main_process:
@@ -296,15 +301,23 @@ def main():
         # Summary
         if step % train_log_every == 0 and accelerator.is_main_process:
             speed = total / (end - start)
+
+            # Reduce on device and copy everything back at once
+            with torch.no_grad():
+                predicted = predicted.detach().float()
+                flow = flow.float()
+                stats = torch.stack([loss.detach().float(), predicted.mean(), predicted.amax(), predicted.amin(), flow.mean(), flow.amax(), flow.amin()]).cpu().tolist()
+            loss, predicted_mean, predicted_max, predicted_min, flow_mean, flow_max, flow_min = stats
+
             accelerator.log({
                 "learning_rate": lr,
                 "loss": loss,
-                "predicted/mean": predicted.mean(),
-                "predicted/max": predicted.max(),
-                "predicted/min": predicted.min(),
-                "target/mean": flow.mean(),
-                "target/max": flow.max(),
-                "target/min": flow.min(),
+                "predicted/mean": predicted_mean,
+                "predicted/max": predicted_max,
+                "predicted/min": predicted_min,
+                "target/mean": flow_mean,
+                "target/max": flow_max,
+                "target/min": flow_min,
                 "data/length": total,
                 "speed": speed
             }, step=step)
@@ -333,6 +346,7 @@ def main():
 #
 
 def cycle(dl):
+    # Loaders use persistent workers, so restarting the iteration doesn't respawn them
     while True:
         for data in dl:
             yield data    
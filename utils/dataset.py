@@ -8,23 +8,125 @@ import torchaudio.transforms as T
 import torchaudio.functional as F
 import math
 import json
+import numpy as np
+from pathlib import Path
 from torch.utils.data import DataLoader
 from tqdm import tqdm
-import textgrid
 from supervoice.model_style import resolve_style
-from supervoice.alignment import compute_alignments
+from supervoice.alignment import pad_discreete_alignments
 from supervoice.config import config
 
+length_multiple = 32 # Bucket size, and batch length granularity for compiled models
+
+class PackedAudio:
+    """
+    Spectograms of a prepared dataset packed by datasets_pack.py into a single memory-mapped (T, C) archive
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + "/files.txt", 'r') as filelist:
+            self.files = {f: i for i, f in enumerate(filelist.read().splitlines())}
+        self.index = np.load(path + "/index.npy")
+        self.audio = None # Opened lazily in each worker
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def length(self, name):
+        return int(self.index[self.files[name]][1])
+
+    def read(self, name, offset = 0, length = None, out = None):
+        if self.audio is None:
+            self.audio = np.memmap(self.path + "/audio.bin", dtype=np.float32, mode='r').reshape(-1, config.audio.n_mels)
+        start, frames = self.index[self.files[name]]
+        if length is None:
+            length = frames - offset
+        assert offset + length <= frames
+        if out is not None: # Copy straight from the mapping into the destination tensor
+            np.copyto(out.numpy(), self.audio[start + offset:start + offset + length])
+            return out
+        return torch.from_numpy(np.array(self.audio[start + offset:start + offset + length]))
+
+
+class PackedAlignments:
+    """
+    Discreete alignments of an aligned dataset packed by datasets_pack.py into flat memory-mapped arrays
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + "/files.txt", 'r') as filelist:
+            self.files = {f: i for i, f in enumerate(filelist.read().splitlines())}
+        self.index = np.load(path + "/index.npy")
+        self.tokens = None # Opened lazily on first read
+        self.durations = None
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def read(self, name):
+        if self.tokens is None:
+            self.tokens = np.load(self.path + "/tokens.npy", mmap_mode='r')
+            self.durations = np.load(self.path + "/durations.npy", mmap_mode='r')
+        start, count = self.index[self.files[name]]
+        return self.tokens[start:start + count], self.durations[start:start + count]
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Groups samples of similar length into batches, reshuffled on every epoch
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size = length_multiple, min_length = 0, seed = 42):
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.count = 0
+        self.buckets = {}
+        for i, l in enumerate(lengths):
+            if l < min_length:
+                continue
+            self.buckets.setdefault(l // bucket_size, []).append(i)
+            self.count += 1
+
+    def __iter__(self):
+
+        # Same order in every process
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+
+        # Shuffle within buckets, leftovers are pooled with the next bucket (collate cuts to the shortest sample)
+        batches = []
+        leftover = []
+        for key in sorted(self.buckets):
+            bucket = self.buckets[key].copy()
+            rng.shuffle(bucket)
+            bucket = leftover + bucket
+            full = len(bucket) - len(bucket) % self.batch_size
+            batches += [bucket[i:i + self.batch_size] for i in range(0, full, self.batch_size)]
+            leftover = bucket[full:]
+        if len(leftover) > 0:
+            batches.append(leftover)
+
+        # Shuffle batches
+        rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return math.ceil(self.count / self.batch_size)
+
+
 class AudioFileListDataset(torch.utils.data.Dataset):
     
     def __init__(self, path, segment_size, limit=None, transformer = None):
         self.segment_size = segment_size
         self.transformer = transformer
+        self.packs = {}
         with open(path, 'r') as filelist:
-            self.rows = list(filelist)
-        random.shuffle(self.rows)
+            self.rows = filelist.read().splitlines() # Not shuffled, use a shuffling sampler in the loader
         if limit is not None:
-            self.rows = self.rows[:limit]
+            self.rows = random.sample(self.rows, min(limit, len(self.rows)))
     
     def __getitem__(self, index):
 
@@ -32,15 +134,34 @@ class AudioFileListDataset(torch.utils.data.Dataset):
         r = self.rows[index]
         filename, length = r.split(',')
 
-        # Load audio
-        audio = torch.load(filename[:-3] + "pt", map_location="cpu").transpose(0, 1)
-
-        # Pad or trim to target duration
-        if audio.shape[0] >= self.segment_size:
-            audio_start = random.randint(0, audio.shape[0] - self.segment_size)
-            audio = audio[audio_start:audio_start+self.segment_size]
-        elif audio.shape[0] < self.segment_size: # Rare or impossible case - just pad with zeros
-            audio = torch.nn.functional.pad(audio, (0, 0, 0, self.segment_size - audio.shape[0]))
+        # Resolve archive (datasets/<name>-prepared/<speaker>/<file>.wav)
+        p = Path(filename)
+        pack_dir = str(p.parents[1])
+        if pack_dir not in self.packs:
+            self.packs[pack_dir] = PackedAudio(pack_dir) if (p.parents[1] / "files.txt").exists() else None
+        pack = self.packs[pack_dir]
+        name = p.parent.name + "/" + p.stem
+
+        # Fallback to a separate spectogram file if dataset is not packed
+        if pack is None or name not in pack:
+            audio = torch.load(str(p.with_suffix(".pt")), map_location="cpu", mmap=True, weights_only=True)
+            if audio.shape[0] >= self.segment_size:
+                audio_start = random.randint(0, audio.shape[0] - self.segment_size)
+                audio = audio[audio_start:audio_start+self.segment_size]
+            else: # Rare or impossible case - just pad with zeros
+                padded = audio.new_zeros((self.segment_size, audio.shape[1]))
+                padded.narrow(0, 0, audio.shape[0]).copy_(audio)
+                audio = padded
+
+        # Load audio, trimmed to target duration
+        else:
+            frames = pack.length(name)
+            if frames >= self.segment_size:
+                audio_start = random.randint(0, frames - self.segment_size)
+                audio = pack.read(name, audio_start, self.segment_size)
+            else: # Rare or impossible case - just pad with zeros
+                audio = torch.zeros((self.segment_size, config.audio.n_mels))
+                pack.read(name, out = audio[:frames])
 
         # Transformer
         if self.transformer is not None:
@@ -64,15 +185,17 @@ class SpecAudioDataset(torch.utils.data.Dataset):
         # Load File
         filename = self.files[index]
 
-        # If in tensor mode
-        audio = torch.load(filename)
+        # If in tensor mode (T, C)
+        audio = torch.load(filename, map_location="cpu", mmap=True, weights_only=True)
 
         # Pad or trim to target duration
-        if audio.shape[1] >= self.segment_size:
-            audio_start = random.randint(0, audio.shape[1] - self.segment_size)
-            audio = audio[:, audio_start:audio_start+self.segment_size]
-        elif audio.shape[1] < self.segment_size: # Rare or impossible case - just pad with zeros
-            audio = torch.nn.functional.pad(audio, (0, self.segment_size - audio.shape[1]))
+        if audio.shape[0] >= self.segment_size:
+            audio_start = random.randint(0, audio.shape[0] - self.segment_size)
+            audio = audio[audio_start:audio_start+self.segment_size]
+        elif audio.shape[0] < self.segment_size: # Rare or impossible case - just pad with zeros
+            padded = audio.new_zeros((self.segment_size, audio.shape[1]))
+            padded.narrow(0, 0, audio.shape[0]).copy_(audio)
+            audio = padded
 
         # Transformer
         if self.transformer is not None:
@@ -121,76 +244,84 @@ def load_mono_audio(src, sample_rate, device=None):
 
     return audio
 
-def get_aligned_dataset_loader(names, voices, max_length, workers, batch_size, tokenizer, phoneme_duration, dtype = None):
+def get_aligned_dataset_loader(names, voices, max_length, workers, batch_size, tokenizer, phoneme_duration, dtype = None, compiled = False):
 
     # Load datasets
     def load_dataset(name):
         dataset_dir = "datasets/" + name + "-aligned"
         dataset_audio_dir = "datasets/" + name + "-prepared"
-        if voices is None:
-            files = glob(dataset_dir + "/**/*.TextGrid")
-        else:
-            files = []
-            for voice in voices:
-                files += glob(dataset_dir + "/" + voice + "/*.TextGrid")
-        files = [f[len(dataset_dir + "/"):-len(".TextGrid")] for f in files]
+        if not Path(dataset_dir + "/files.txt").exists() or not Path(dataset_audio_dir + "/files.txt").exists():
+            raise Exception("Dataset " + name + " is not packed, run python datasets_pack.py " + name)
+        alignments = PackedAlignments(dataset_dir)
+        files = list(alignments.files)
+        if voices is not None:
+            files = [f for f in files if f.split("/")[0] in voices]
 
-        # Load textgrids
-        tg = [textgrid.TextGrid.fromFile(dataset_dir + "/" + f + ".TextGrid") for f in tqdm(files)]
+        # Alignments
+        alignments = [(alignments, f) for f in files]
 
         # Style tokens
         styles = [dataset_audio_dir + "/" + f + ".style.pt" for f in files]
 
         # Load audio
+        pack = PackedAudio(dataset_audio_dir)
+        audio = [(pack, f) for f in files]
+        lengths = [pack.length(f) for f in files]
         files = [dataset_audio_dir + "/" + f + ".pt" for f in files]
 
-        return tg, files, styles
+        return alignments, files, styles, audio, lengths
 
     # Load all datasets
     files = []
-    tg = []
+    alignments = []
     styles = []
+    audio = []
+    lengths = []
     for name in names:
-        t, f, s = load_dataset(name)
+        t, f, s, a, l = load_dataset(name)
         files += f
-        tg += t
+        alignments += t
         styles += s
-
-    # Sort two lists by length together
-    tg, files, styles = zip(*sorted(zip(tg, files, styles), key=lambda x: (-x[0].maxTime, x[1])))
+        audio += a
+        lengths += l
 
     class AlignedDataset(torch.utils.data.Dataset):
-        def __init__(self, textgrid, files, styles):
+        def __init__(self, alignments, files, styles, audio):
             self.files = files
             self.styles = styles
-            self.textgrid = textgrid
+            self.audio = audio
+
+            # Pad and expand phonemes of every file once
+            phonemes = []
+            durations = []
+            for (pack, name), (a, _) in zip(tqdm(audio), alignments):
+                t, d = a.read(name)
+                try:
+                    t, d = pad_discreete_alignments(t, d, pack.length(name), tokenizer.silence_token_id)
+                except AssertionError:
+                    raise Exception("Alignments are longer than audio in " + a.path + "/" + name)
+                phonemes.append(np.repeat(t.astype(np.int16), d))
+                durations.append(d.astype(np.int32))
+            self.phonemes_index = np.cumsum([0] + [len(p) for p in phonemes])
+            self.phonemes = np.concatenate(phonemes)
+            self.durations_index = np.cumsum([0] + [len(d) for d in durations])
+            self.durations = np.concatenate(durations)
         def __len__(self):
             return len(self.files)        
         def __getitem__(self, index):
 
             try:
 
-                # Spectogram
-                audio = torch.load(self.files[index])
-                audio = audio.transpose(0, 1) # Reshape audio (C, T) -> (T, C)
+                # Phonemes
+                phonemes = self.phonemes[self.phonemes_index[index]:self.phonemes_index[index + 1]]
+                durations = self.durations[self.durations_index[index]:self.durations_index[index + 1]]
 
                 # Styles
-                style = torch.load(self.styles[index])
-
-                # Phonemes
-                aligned_phonemes = compute_alignments(config, self.textgrid[index], style, audio.shape[0])
-
-                # Unwrap phonemes
-                phonemes = []
-                styles = []
-                for t in aligned_phonemes:
-                    for i in range(t[1]):
-                        phonemes.append(t[0])
-                        styles.append(t[2])
-                if len(phonemes) != audio.shape[0]:
-                    raise Exception("Phonemes and audio length mismatch: " + str(len(phonemes)) + " != " + str(audio.shape[0]) + " in " + self.files[index])
+                style = torch.load(self.styles[index], map_location="cpu", mmap=True, weights_only=True) # Copy-on-write mapping, safe to modify
+                styles = np.repeat(np.array(resolve_style(config, style, durations.tolist()), dtype=np.int64) + 1, durations)
 
                 # Length
+                pack, name = self.audio[index]
                 l = len(phonemes)
                 offset = 0
                 if l  > max_length:
@@ -198,13 +329,9 @@ def get_aligned_dataset_loader(names, voices, max_length, workers, batch_size, t
                     offset = random.randint(0, len(phonemes) - l)
         
                 # Cut to size
-                phonemes = phonemes[offset:offset+l]
-                styles = styles[offset:offset+l]
-                audio = audio[offset:offset+l]
-
-                # Tokenize
-                phonemes = tokenizer(phonemes)
-                styles = torch.tensor(styles).long()
+                phonemes = torch.from_numpy(phonemes[offset:offset+l].astype(np.int64))
+                styles = torch.from_numpy(styles[offset:offset+l])
+                audio = pack.read(name, offset, l)
 
                 # Cast
                 if dtype is not None:
@@ -218,42 +345,45 @@ def get_aligned_dataset_loader(names, voices, max_length, workers, batch_size, t
                 raise e
 
     # Create dataset
-    dataset = AlignedDataset(tg, files, styles)
+    dataset = AlignedDataset(alignments, files, styles, audio)
+
+    # Batch samples of similar length (everything longer than max_length is cut to it)
+    # Compiled model: skip samples too short to be rounded, each would be a new shape
+    sampler = BucketBatchSampler([min(l, max_length) for l in lengths], batch_size, min_length = length_multiple if compiled else 0)
 
     def collate_to_shortest(batch):
 
         # Find minimum length
         min_len = min([b[0].shape[0] for b in batch])
 
-        # Pad
-        padded = []
-        for b in batch:
-            if b[0].shape[0] > min_len:
-                offset = random.randint(0, b[0].shape[0] - min_len)
-                padded.append((
-                    b[0][offset:offset + min_len],
-                    b[1][offset:offset + min_len],
-                    b[2][offset:offset + min_len]
-                ))
-            else:
-                padded.append((
-                    b[0],
-                    b[1],
-                    b[2]
-                ))
-        return torch.stack([b[0] for b in padded]), torch.stack([b[1] for b in padded]), torch.stack([b[2] for b in padded])
+        # Compiled model: round down to keep the number of distinct shapes (and compiled graphs) small
+        if compiled and min_len < max_length:
+            min_len = min_len - min_len % length_multiple
+
+        # Allocate outputs
+        tokens = torch.empty((len(batch), min_len), dtype = batch[0][0].dtype)
+        styles = torch.empty((len(batch), min_len), dtype = batch[0][1].dtype)
+        audio = torch.empty((len(batch), min_len, batch[0][2].shape[1]), dtype = batch[0][2].dtype)
 
-    return DataLoader(dataset, num_workers=workers, shuffle=False, batch_size=batch_size, pin_memory=True, collate_fn=collate_to_shortest)
+        # Cut to length
+        for i, b in enumerate(batch):
+            offset = random.randint(0, b[0].shape[0] - min_len)
+            tokens[i].copy_(b[0][offset:offset + min_len])
+            styles[i].copy_(b[1][offset:offset + min_len])
+            audio[i].copy_(b[2][offset:offset + min_len])
+        return tokens, styles, audio
+
+    return DataLoader(dataset, num_workers=workers, persistent_workers=workers > 0, prefetch_factor=4 if workers > 0 else None, batch_sampler=sampler, pin_memory=True, collate_fn=collate_to_shortest)
 
 def get_aligned_dataset_dumb_loader(path, max_length, workers, batch_size, tokenizer, phoneme_duration, dtype = None):
 
     # Dataset
     def transformer(data):
         return torch.zeros(data.shape[0]).long(), data
-    dataset = AudioFileListDataset(path, max_length, transformer)
+    dataset = AudioFileListDataset(path, max_length, transformer = transformer)
 
     # Loader
-    return DataLoader(dataset, num_workers=workers, shuffle=False, batch_size=batch_size, pin_memory=True)
+    return DataLoader(dataset, num_workers=workers, persistent_workers=workers > 0, prefetch_factor=4 if workers > 0 else None, shuffle=True, batch_size=batch_size, pin_memory=True)
 
 def get_audio_spectogram_loader(path, max_length, workers, batch_size, limit = None, dtype = None):
 
@@ -261,7 +391,7 @@ def get_audio_spectogram_loader(path, max_length, workers, batch_size, limit = N
     dataset = AudioFileListDataset(path, max_length, limit=limit)
 
     # Loader
-    return DataLoader(dataset, num_workers=workers, shuffle=False, batch_size=batch_size, pin_memory=False)
+    return DataLoader(dataset, num_workers=workers, persistent_workers=workers > 0, prefetch_factor=4 if workers > 0 else None, shuffle=True, batch_size=batch_size, pin_memory=False)
 
 
 def get_phonemes_dataset(path, max_length, workers, batch_size, tokenizer, phoneme_duration, dtype = None):
@@ -270,33 +400,30 @@ def get_phonemes_dataset(path, max_length, workers, batch_size, tokenizer, phone
     def transformer(data):
 
         # Convert to phonemes and durations
-        phonemes, durations = [], []
-        last_time = 0
-        last_silence = True
-        for word in data['w']:
-
-            # Extract data
-            start = word['t'][0]
-            end = word['t'][1]
-
-            # Process word or silence
-            if word['w'] is None:
-                durations.append(round((end - start) / phoneme_duration))
-                phonemes.append(tokenizer.silence_token)
-                last_silence = True
-            else:
-                if not last_silence: # Add empty silence
-                    durations.append(0)
-                    phonemes.append(tokenizer.silence_token)
-                last_silence = False
-                for phone in word['p']:
-                    if phone['p'] is not None:
-                        phonemes.append(phone['p'])
-                        durations.append(round((phone['t'][1] - phone['t'][0]) / phoneme_duration))
+        def intervals():
+            last_silence = True
+            for word in data['w']:
+
+                # Extract data
+                start = word['t'][0]
+                end = word['t'][1]
+
+                # Process word or silence
+                if word['w'] is None:
+                    yield tokenizer.silence_token, round((end - start) / phoneme_duration)
+                    last_silence = True
+                else:
+                    if not last_silence: # Add empty silence
+                        yield tokenizer.silence_token, 0
+                    last_silence = False
+                    for phone in word['p']:
+                        if phone['p'] is not None:
+                            yield phone['p'], round((phone['t'][1] - phone['t'][0]) / phoneme_duration)
+        pairs = np.fromiter(intervals(), dtype=[('p', 'O'), ('d', 'i8')])
 
         # Convert to tensor
-        phonemes = tokenizer(phonemes)
-        durations = torch.tensor(durations)
+        phonemes = tokenizer(pairs['p'].tolist())
+        durations = torch.from_numpy(np.ascontiguousarray(pairs['d']))
 
         # Cast
         if dtype is not None:
@@ -330,4 +457,4 @@ def get_phonemes_dataset(path, max_length, workers, batch_size, tokenizer, phone
                 ))
         return torch.stack([b[0] for b in padded]), torch.stack([b[1] for b in padded])
 
-    return DataLoader(dataset, num_workers=workers, shuffle=False, batch_size=batch_size, pin_memory=True, collate_fn=collate_to_shortest)
\ No newline at end of file
+    return DataLoader(dataset, num_workers=workers, persistent_workers=workers > 0, prefetch_factor=4 if workers > 0 else None, shuffle=False, batch_size=batch_size, pin_memory=True, collate_fn=collate_to_shortest)
\ No newline at end of file